@@ -0,0 +1,151 @@
+# replica_set_check.py
+# Local replica set check for history read routing and read-your-writes.
+#
+# Start two mongod members on one host with test commands enabled:
+#   mongod --replSet rs0 --dbpath /tmp/rs0-0 --port 27017 --bind_ip localhost --setParameter enableTestCommands=1
+#   mongod --replSet rs0 --dbpath /tmp/rs0-1 --port 27018 --bind_ip localhost --setParameter enableTestCommands=1
+# then run: python backend/replica_set_check.py
+import asyncio
+import os
+import uuid
+from types import SimpleNamespace
+from bson import Timestamp
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.read_concern import ReadConcern
+from pymongo.read_preferences import Secondary, SecondaryPreferred
+
+primary_host = os.environ.get("REPLICA_SET_PRIMARY", "localhost:27017")
+secondary_host = os.environ.get("REPLICA_SET_SECONDARY", "localhost:27018")
+replica_set = os.environ.get("REPLICA_SET_NAME", "rs0")
+db_name = "laundry_db_replica_check"
+
+
+def direct_client(host):
+    return AsyncIOMotorClient(f"mongodb://{host}/?directConnection=true")
+
+
+async def initiate_replica_set():
+    primary = direct_client(primary_host)
+    try:
+        try:
+            await primary.admin.command("replSetGetStatus")
+            print("Replica set already initiated")
+        except Exception:
+            # The secondary has priority 0 so it can never take over as primary
+            await primary.admin.command("replSetInitiate", {
+                "_id": replica_set,
+                "members": [
+                    {"_id": 0, "host": primary_host},
+                    {"_id": 1, "host": secondary_host, "priority": 0}
+                ]
+            })
+            print("Replica set initiated")
+
+        for _ in range(60):
+            status = await primary.admin.command("replSetGetStatus")
+            states = sorted(member["stateStr"] for member in status["members"])
+            if states == ["PRIMARY", "SECONDARY"]:
+                break
+            await asyncio.sleep(1)
+        else:
+            raise RuntimeError(f"Replica set did not become ready: {states}")
+
+        # Writes must not wait on the secondary while its replication is paused
+        await primary.admin.command("setDefaultRWConcern", defaultWriteConcern={"w": 1})
+    finally:
+        primary.close()
+
+
+async def set_replication_paused(paused: bool):
+    secondary = direct_client(secondary_host)
+    try:
+        await secondary.admin.command(
+            "configureFailPoint", "stopReplProducer", mode="alwaysOn" if paused else "off"
+        )
+    finally:
+        secondary.close()
+
+
+def check_read_settings(server):
+    assert server.all_laundry_entries.read_preference == SecondaryPreferred(max_staleness=90)
+    assert server.all_laundry_entries.read_concern == ReadConcern("local")
+    # Pinned to the secondary by main() so the causal wait below is deterministic
+    assert server.student_laundry_entries.read_preference == Secondary(max_staleness=90)
+
+    invalid = [
+        ("READ_PREFERENCE", "fastest"),
+        ("READ_CONCERN", "eventual"),
+        # Primary-only, and not usable with afterClusterTime on the default secondaryPreferred
+        ("READ_CONCERN", "linearizable"),
+        ("MAX_STALENESS_SECONDS", "30"),
+    ]
+    for name, value in invalid:
+        os.environ[f"CHECK_{name}"] = value
+        try:
+            server.history_collection("CHECK")
+        except ValueError:
+            pass
+        else:
+            raise AssertionError(f"history_collection accepted {name}={value}")
+        finally:
+            del os.environ[f"CHECK_{name}"]
+    print("Read settings parsed and validated")
+
+
+async def check_read_your_writes(server):
+    worker = server.User(user_id=str(uuid.uuid4()), email="worker@check.com", name="Check Worker", role="worker")
+    entry = server.LaundryEntryCreate(
+        student_id="STU-RS",
+        student_name="Check Student",
+        items=[server.LaundryItem(item_type="Shirt", quantity=1)]
+    )
+
+    await set_replication_paused(True)
+    try:
+        created = await server._create_entry(entry, worker, str(uuid.uuid4()))
+        query = {"entry_id": created["entry_id"]}
+
+        stale = await server.student_laundry_entries.find_one(query, {"_id": 0})
+        assert stale is None, "Secondary should not have the entry while replication is paused"
+
+        # An older write finishing late must not move the user's token backwards
+        token = await server.db.causal_tokens.find_one({"_id": worker.user_id})
+        await server.remember_write(worker, SimpleNamespace(operation_time=Timestamp(1, 1), cluster_time=None))
+        assert (await server.db.causal_tokens.find_one({"_id": worker.user_id}))["operation_time"] == token["operation_time"]
+
+        # A short time limit gives up on the lagging secondary and reads the primary
+        server.HISTORY_READ_MAX_TIME_MS = 500
+        entries = await asyncio.wait_for(server.read_history(server.student_laundry_entries, query, worker), timeout=10)
+        assert [e["entry_id"] for e in entries] == [created["entry_id"]]
+        print("Timed out causal read fell back to the primary")
+
+        server.HISTORY_READ_MAX_TIME_MS = 60000
+        read = asyncio.create_task(server.read_history(server.student_laundry_entries, query, worker))
+        await asyncio.sleep(2)
+        assert not read.done(), "Causal read should wait for the secondary to catch up"
+    finally:
+        await set_replication_paused(False)
+
+    entries = await asyncio.wait_for(read, timeout=30)
+    assert [e["entry_id"] for e in entries] == [created["entry_id"]]
+    print("Causal read on the secondary waited for and returned the user's own write")
+
+
+async def main():
+    os.environ["MONGO_URL"] = f"mongodb://{primary_host},{secondary_host}/?replicaSet={replica_set}"
+    os.environ["DB_NAME"] = db_name
+    os.environ["LAUNDRY_STUDENT_READ_PREFERENCE"] = "secondary"
+
+    await initiate_replica_set()
+
+    import server
+    try:
+        check_read_settings(server)
+        await check_read_your_writes(server)
+    finally:
+        await server.client.drop_database(db_name)
+        server.client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
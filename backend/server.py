@@ -1,15 +1,24 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Header
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, ExecutionTimeout
+from bson import Timestamp
+from pymongo.read_concern import ReadConcern
+from pymongo.read_preferences import Primary, PrimaryPreferred, Secondary, SecondaryPreferred, Nearest
 import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, EmailStr
-from typing import List, Optional
+from typing import List, Optional, Literal
+from collections import OrderedDict
 import uuid
-from datetime import datetime, timezone
+import time
+import json
+import hashlib
+from datetime import datetime, timezone, timedelta
 import bcrypt
 import jwt
 import resend
@@ -26,6 +35,51 @@ resend.api_key = os.environ.get('RESEND_API_KEY', '')
 SENDER_EMAIL = os.environ.get('SENDER_EMAIL', 'onboarding@resend.dev')
 JWT_SECRET = os.environ.get('JWT_SECRET', 'your-secret-key-change-in-production')
 
+# Idempotency-Key support for retried worker writes
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get('IDEMPOTENCY_TTL_SECONDS', 24 * 60 * 60))
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get('IDEMPOTENCY_CACHE_SIZE', 1000))
+IDEMPOTENCY_LEASE_SECONDS = int(os.environ.get('IDEMPOTENCY_LEASE_SECONDS', 60))
+SYNC_MAX_OPERATIONS = int(os.environ.get('SYNC_MAX_OPERATIONS', 100))
+
+# Read routing for heavy history/list queries. Auth and post-write reads
+# keep using the default db handle, which always reads from the primary.
+READ_PREFERENCES = {
+    'primary': Primary,
+    'primaryPreferred': PrimaryPreferred,
+    'secondary': Secondary,
+    'secondaryPreferred': SecondaryPreferred,
+    'nearest': Nearest,
+}
+# History reads run in causal sessions, which need afterClusterTime support
+READ_CONCERNS = ('local', 'majority')
+CAUSAL_TOKEN_TTL_SECONDS = int(os.environ.get('CAUSAL_TOKEN_TTL_SECONDS', 10 * 60))
+HISTORY_READ_MAX_TIME_MS = int(os.environ.get('HISTORY_READ_MAX_TIME_MS', 2000))
+
+def history_collection(route: str):
+    """laundry_entries handle configured from <ROUTE>_READ_PREFERENCE, _MAX_STALENESS_SECONDS and _READ_CONCERN."""
+    mode = os.environ.get(f'{route}_READ_PREFERENCE', 'secondaryPreferred')
+    max_staleness = int(os.environ.get(f'{route}_MAX_STALENESS_SECONDS', 90))
+    read_concern = os.environ.get(f'{route}_READ_CONCERN', 'local')
+
+    if mode not in READ_PREFERENCES:
+        raise ValueError(f"Unknown read preference for {route}: {mode}")
+    if read_concern not in READ_CONCERNS:
+        raise ValueError(f"Read concern for {route} must be one of {', '.join(READ_CONCERNS)}: {read_concern}")
+    if max_staleness != -1 and max_staleness < 90:
+        raise ValueError(f"Max staleness for {route} must be -1 or at least 90 seconds: {max_staleness}")
+    if mode == 'primary':
+        read_preference = Primary()
+    else:
+        read_preference = READ_PREFERENCES[mode](max_staleness=max_staleness)
+
+    return db.laundry_entries.with_options(
+        read_preference=read_preference,
+        read_concern=ReadConcern(read_concern)
+    )
+
+all_laundry_entries = history_collection('LAUNDRY_ALL')
+student_laundry_entries = history_collection('LAUNDRY_STUDENT')
+
 app = FastAPI()
 
 # CORS Middleware (must be before routes)
@@ -52,6 +106,19 @@ async def test_db():
         print("✅ MongoDB Connected Successfully")
     except Exception as e:
         print("❌ MongoDB Connection Failed:", e)
+        return
+
+    # Stored responses expire on their own via a TTL index
+    try:
+        await db.idempotency_keys.create_index("key", unique=True)
+        await db.idempotency_keys.create_index("created_at", expireAfterSeconds=IDEMPOTENCY_TTL_SECONDS)
+    except Exception as e:
+        logger.error(f"Failed to create idempotency indexes: {str(e)}")
+
+    try:
+        await db.causal_tokens.create_index("updated_at", expireAfterSeconds=CAUSAL_TOKEN_TTL_SECONDS)
+    except Exception as e:
+        logger.error(f"Failed to create causal token index: {str(e)}")
 
 
 # Models
@@ -99,6 +166,15 @@ class LaundryComplete(BaseModel):
 class LaundryPickup(BaseModel):
     entry_id: str
 
+class SyncOperation(BaseModel):
+    idempotency_key: str = Field(min_length=1)
+    op: Literal["create", "complete"]
+    entry: Optional[LaundryEntryCreate] = None
+    entry_id: Optional[str] = None
+
+class SyncBatch(BaseModel):
+    operations: List[SyncOperation]
+
 # Auth helpers
 def hash_password(password: str) -> str:
     return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
@@ -124,6 +200,177 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
         raise HTTPException(status_code=401, detail="User not found")
     return User(**user)
 
+# Causal consistency helpers: each user's latest write time is kept in the
+# causal_tokens collection, so their next history read waits for that write on
+# a secondary no matter which server process handles it
+async def remember_write(current_user: User, session):
+    if session.operation_time is None:
+        return
+    zero = Timestamp(0, 0)
+    cluster_time = session.cluster_time
+    update = {
+        # $max keeps the newest time when one user's writes finish out of order
+        "operation_time": {"$max": [{"$ifNull": ["$operation_time", zero]}, session.operation_time]},
+        "updated_at": "$$NOW"
+    }
+    if cluster_time is not None:
+        update["cluster_time"] = {"$cond": [
+            {"$gt": [cluster_time["clusterTime"], {"$ifNull": ["$cluster_time.clusterTime", zero]}]},
+            {"$literal": cluster_time},
+            "$cluster_time"
+        ]}
+    try:
+        await db.causal_tokens.update_one({"_id": current_user.user_id}, [{"$set": update}], upsert=True)
+    except Exception as e:
+        # The entry write already succeeded; only read-your-writes is lost
+        logger.error(f"Failed to store causal token: {str(e)}")
+
+async def causal_session(current_user: User):
+    session = await client.start_session(causal_consistency=True)
+    # Looked up on the primary, which also gossips a cluster time at least this new
+    try:
+        token = await db.causal_tokens.find_one({"_id": current_user.user_id})
+    except Exception as e:
+        logger.error(f"Failed to load causal token: {str(e)}")
+        token = None
+    if token:
+        if token.get("cluster_time"):
+            session.advance_cluster_time(token["cluster_time"])
+        session.advance_operation_time(token["operation_time"])
+    return session
+
+async def read_history(collection, query: dict, current_user: User) -> list:
+    """Sorted history read on the routed collection, falling back to the primary
+    when a lagging secondary cannot catch up to the user's last write in time."""
+    async with await causal_session(current_user) as session:
+        try:
+            return await collection.find(
+                query, {"_id": 0}, session=session, max_time_ms=HISTORY_READ_MAX_TIME_MS
+            ).sort("submission_date", -1).to_list(1000)
+        except ExecutionTimeout:
+            logger.warning("History read timed out on secondary, retrying on primary")
+    return await db.laundry_entries.find(query, {"_id": 0}).sort("submission_date", -1).to_list(1000)
+
+# Idempotency helpers
+_idempotency_cache: "OrderedDict[str, tuple]" = OrderedDict()
+
+def _cache_get(key: str) -> Optional[dict]:
+    cached = _idempotency_cache.get(key)
+    if not cached:
+        return None
+    expires_at, record = cached
+    if expires_at < time.monotonic():
+        _idempotency_cache.pop(key, None)
+        return None
+    _idempotency_cache.move_to_end(key)
+    return record
+
+def _cache_put(key: str, record: dict):
+    # Expire with the Mongo TTL index, so this process never replays a key the others have dropped
+    created_at = record["created_at"]
+    if created_at.tzinfo is None:
+        created_at = created_at.replace(tzinfo=timezone.utc)
+    remaining = IDEMPOTENCY_TTL_SECONDS - (datetime.now(timezone.utc) - created_at).total_seconds()
+    if remaining <= 0:
+        return
+    _idempotency_cache[key] = (time.monotonic() + remaining, record)
+    _idempotency_cache.move_to_end(key)
+    while len(_idempotency_cache) > IDEMPOTENCY_CACHE_SIZE:
+        _idempotency_cache.popitem(last=False)
+
+def _request_hash(route: str, payload: dict) -> str:
+    canonical = json.dumps({"route": route, "payload": payload}, sort_keys=True, default=str)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+async def _release_lease(key: str, lease_id: str):
+    try:
+        await db.idempotency_keys.update_one(
+            {"key": key, "lease_id": lease_id, "status": "pending"},
+            {"$set": {"leased_at": datetime.fromtimestamp(0, timezone.utc)}}
+        )
+    except Exception as e:
+        logger.error(f"Failed to release idempotency lease: {str(e)}")
+
+async def run_idempotent(idempotency_key: Optional[str], route: str, payload: dict, current_user: User, handler):
+    """Run handler once per Idempotency-Key and replay the stored response on retries.
+
+    handler gets a request_id that stays the same for every retry of one key, so a
+    retry that takes over an abandoned request repeats the same write instead of a new one.
+    """
+    if not idempotency_key:
+        return await handler(str(uuid.uuid4()))
+
+    # Keys are scoped per user so two workers can never collide
+    key = f"{current_user.user_id}:{idempotency_key}"
+    request_hash = _request_hash(route, payload)
+
+    record = _cache_get(key)
+    if not record:
+        record = await db.idempotency_keys.find_one({"key": key}, {"_id": 0})
+        if record and record["status"] == "completed":
+            _cache_put(key, record)
+    if record:
+        if record["route"] != route:
+            raise HTTPException(status_code=422, detail="Idempotency-Key already used for a different request")
+        if record["request_hash"] != request_hash:
+            raise HTTPException(status_code=422, detail="Idempotency-Key already used with a different payload")
+        if record["status"] == "completed":
+            return record["response"]
+
+    now = datetime.now(timezone.utc)
+    lease_id = str(uuid.uuid4())
+    if not record:
+        record = {
+            "key": key,
+            "route": route,
+            "request_hash": request_hash,
+            "request_id": str(uuid.uuid4()),
+            "status": "pending",
+            "lease_id": lease_id,
+            "leased_at": now,
+            "created_at": now
+        }
+        try:
+            await db.idempotency_keys.insert_one(dict(record))
+        except DuplicateKeyError:
+            raise HTTPException(status_code=409, detail="Request with this Idempotency-Key is still in progress")
+    else:
+        # Take over a request whose owner crashed, was cancelled or failed to store its response
+        record = await db.idempotency_keys.find_one_and_update(
+            {
+                "key": key,
+                "status": "pending",
+                "leased_at": {"$lt": now - timedelta(seconds=IDEMPOTENCY_LEASE_SECONDS)}
+            },
+            {"$set": {"lease_id": lease_id, "leased_at": now}},
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER
+        )
+        if not record:
+            raise HTTPException(status_code=409, detail="Request with this Idempotency-Key is still in progress")
+
+    completed = False
+    try:
+        response = await handler(record["request_id"])
+        await db.idempotency_keys.update_one(
+            {"key": key, "lease_id": lease_id},
+            {"$set": {"status": "completed", "response": response}}
+        )
+        completed = True
+    except HTTPException:
+        # Rejected requests wrote nothing, so the key is freed for a corrected retry
+        await db.idempotency_keys.delete_one({"key": key, "lease_id": lease_id, "status": "pending"})
+        completed = True
+        raise
+    finally:
+        # Anything else, including cancellation, may have written already: release the
+        # lease so the next retry takes over right away and repeats the same request_id
+        if not completed:
+            await _release_lease(key, lease_id)
+
+    _cache_put(key, {**record, "status": "completed", "response": response})
+    return response
+
 # Auth endpoints
 @api_router.post("/auth/register")
 async def register(user_data: UserRegister):
@@ -201,13 +448,11 @@ async def login(credentials: UserLogin):
     }
 
 # Laundry endpoints
-@api_router.post("/laundry/create")
-async def create_laundry_entry(entry_data: LaundryEntryCreate, current_user: User = Depends(get_current_user)):
+async def _create_entry(entry_data: LaundryEntryCreate, current_user: User, entry_id: str) -> dict:
     if current_user.role != "worker":
         raise HTTPException(status_code=403, detail="Only workers can create entries")
     
     total_items = sum(item.quantity for item in entry_data.items)
-    entry_id = str(uuid.uuid4())
     
     entry_doc = {
         "entry_id": entry_id,
@@ -221,15 +466,34 @@ async def create_laundry_entry(entry_data: LaundryEntryCreate, current_user: Use
         "worker_id": current_user.user_id
     }
     
-    await db.laundry_entries.insert_one(entry_doc)
+    async with await client.start_session(causal_consistency=True) as session:
+        # Upsert on entry_id so a retried create never inserts the entry twice
+        await db.laundry_entries.update_one(
+            {"entry_id": entry_id},
+            {"$setOnInsert": entry_doc},
+            upsert=True,
+            session=session
+        )
+        await remember_write(current_user, session)
     return {"message": "Laundry entry created", "entry_id": entry_id}
 
+@api_router.post("/laundry/create")
+async def create_laundry_entry(
+    entry_data: LaundryEntryCreate,
+    current_user: User = Depends(get_current_user),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
+):
+    return await run_idempotent(
+        idempotency_key, "laundry/create", entry_data.model_dump(), current_user,
+        lambda request_id: _create_entry(entry_data, current_user, request_id)
+    )
+
 @api_router.get("/laundry/all")
 async def get_all_laundry(current_user: User = Depends(get_current_user)):
     if current_user.role != "worker":
         raise HTTPException(status_code=403, detail="Only workers can view all entries")
     
-    entries = await db.laundry_entries.find({}, {"_id": 0}).sort("submission_date", -1).to_list(1000)
+    entries = await read_history(all_laundry_entries, {}, current_user)
     return entries
 
 @api_router.get("/laundry/student/{student_id}")
@@ -237,23 +501,25 @@ async def get_student_laundry(student_id: str, current_user: User = Depends(get_
     if current_user.role == "student" and current_user.student_id != student_id:
         raise HTTPException(status_code=403, detail="Cannot access other student's data")
     
-    entries = await db.laundry_entries.find({"student_id": student_id}, {"_id": 0}).sort("submission_date", -1).to_list(1000)
+    entries = await read_history(student_laundry_entries, {"student_id": student_id}, current_user)
     return entries
 
-@api_router.put("/laundry/complete")
-async def complete_laundry(data: LaundryComplete, current_user: User = Depends(get_current_user)):
+async def _complete_entry(entry_id: str, current_user: User) -> dict:
     if current_user.role != "worker":
         raise HTTPException(status_code=403, detail="Only workers can mark as completed")
     
-    entry = await db.laundry_entries.find_one({"entry_id": data.entry_id}, {"_id": 0})
+    entry = await db.laundry_entries.find_one({"entry_id": entry_id}, {"_id": 0})
     if not entry:
         raise HTTPException(status_code=404, detail="Entry not found")
     
     completion_date = datetime.now(timezone.utc).isoformat()
-    await db.laundry_entries.update_one(
-        {"entry_id": data.entry_id},
-        {"$set": {"status": "completed", "completion_date": completion_date}}
-    )
+    async with await client.start_session(causal_consistency=True) as session:
+        await db.laundry_entries.update_one(
+            {"entry_id": entry_id},
+            {"$set": {"status": "completed", "completion_date": completion_date}},
+            session=session
+        )
+        await remember_write(current_user, session)
     
     student = await db.users.find_one({"student_id": entry['student_id']}, {"_id": 0})
     if student and resend.api_key:
@@ -304,7 +570,56 @@ async def complete_laundry(data: LaundryComplete, current_user: User = Depends(g
         except Exception as e:
             logger.error(f"Failed to send email: {str(e)}")
     
-    return {"message": "Laundry marked as completed", "entry_id": data.entry_id}
+    return {"message": "Laundry marked as completed", "entry_id": entry_id}
+
+@api_router.put("/laundry/complete")
+async def complete_laundry(
+    data: LaundryComplete,
+    current_user: User = Depends(get_current_user),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
+):
+    return await run_idempotent(
+        idempotency_key, "laundry/complete", data.model_dump(), current_user,
+        lambda request_id: _complete_entry(data.entry_id, current_user)
+    )
+
+@api_router.post("/laundry/sync")
+async def sync_laundry(batch: SyncBatch, current_user: User = Depends(get_current_user)):
+    """Apply a worker's queued offline operations in order, one result per operation."""
+    if current_user.role != "worker":
+        raise HTTPException(status_code=403, detail="Only workers can sync entries")
+    if len(batch.operations) > SYNC_MAX_OPERATIONS:
+        raise HTTPException(status_code=413, detail=f"At most {SYNC_MAX_OPERATIONS} operations per sync")
+
+    results = []
+    for operation in batch.operations:
+        if operation.op == "create" and operation.entry:
+            payload = operation.entry.model_dump()
+            handler = lambda request_id, op=operation: _create_entry(op.entry, current_user, request_id)
+        elif operation.op == "complete" and operation.entry_id:
+            payload = LaundryComplete(entry_id=operation.entry_id).model_dump()
+            handler = lambda request_id, op=operation: _complete_entry(op.entry_id, current_user)
+        else:
+            results.append({
+                "idempotency_key": operation.idempotency_key,
+                "status_code": 422,
+                "detail": f"Missing payload for '{operation.op}' operation"
+            })
+            continue
+
+        try:
+            response = await run_idempotent(
+                operation.idempotency_key, f"laundry/{operation.op}", payload, current_user, handler
+            )
+            results.append({"idempotency_key": operation.idempotency_key, "status_code": 200, "response": response})
+        except HTTPException as e:
+            results.append({"idempotency_key": operation.idempotency_key, "status_code": e.status_code, "detail": e.detail})
+        except Exception as e:
+            # Keep going so the client still gets a result for every queued operation
+            logger.error(f"Sync operation {operation.idempotency_key} failed: {str(e)}")
+            results.append({"idempotency_key": operation.idempotency_key, "status_code": 500, "detail": "Internal server error"})
+
+    return {"results": results}
 
 @api_router.put("/laundry/pickup")
 async def pickup_laundry(data: LaundryPickup, current_user: User = Depends(get_current_user)):
@@ -315,10 +630,13 @@ async def pickup_laundry(data: LaundryPickup, current_user: User = Depends(get_c
     if current_user.role == "student" and entry['student_id'] != current_user.student_id:
         raise HTTPException(status_code=403, detail="Cannot mark other student's laundry")
     
-    await db.laundry_entries.update_one(
-        {"entry_id": data.entry_id},
-        {"$set": {"status": "picked_up"}}
-    )
+    async with await client.start_session(causal_consistency=True) as session:
+        await db.laundry_entries.update_one(
+            {"entry_id": data.entry_id},
+            {"$set": {"status": "picked_up"}},
+            session=session
+        )
+        await remember_write(current_user, session)
     
     return {"message": "Laundry marked as picked up", "entry_id": data.entry_id}
 
@@ -1,5 +1,6 @@
 import requests
 import sys
+import os
 import json
 from datetime import datetime
 
@@ -19,6 +20,7 @@ class LaundrySystemTester:
         self.student_email = f"student_{self.timestamp}@test.com"
         self.student_id = f"STU{self.timestamp}"
         self.test_entry_id = None
+        self.idempotent_entry_id = None
 
     def log_test(self, name, success, details=""):
         """Log test result"""
@@ -35,7 +37,7 @@ class LaundrySystemTester:
             "details": details
         })
 
-    def make_request(self, method, endpoint, data=None, token=None):
+    def make_request(self, method, endpoint, data=None, token=None, extra_headers=None):
         """Make HTTP request with proper headers"""
         url = f"{self.api_url}{endpoint}"
         headers = {'Content-Type': 'application/json'}
@@ -43,6 +45,9 @@ class LaundrySystemTester:
         if token:
             headers['Authorization'] = f'Bearer {token}'
         
+        if extra_headers:
+            headers.update(extra_headers)
+        
         try:
             if method == 'GET':
                 response = requests.get(url, headers=headers, timeout=10)
@@ -185,6 +190,154 @@ class LaundrySystemTester:
         
         return False
 
+    def test_idempotent_create(self):
+        """Test that retrying create with the same Idempotency-Key does not duplicate the entry"""
+        if not self.worker_token:
+            self.log_test("Idempotent Create Replay", False, "No worker token available")
+            return False
+        
+        data = {
+            "student_id": self.student_id,
+            "student_name": "Test Student",
+            "items": [{"item_type": "Towel", "quantity": 1}]
+        }
+        headers = {'Idempotency-Key': f"create-{self.timestamp}"}
+        
+        first = self.make_request('POST', '/laundry/create', data, self.worker_token, headers)
+        second = self.make_request('POST', '/laundry/create', data, self.worker_token, headers)
+        
+        if first and second and first.status_code == 200 and second.status_code == 200:
+            if first.json().get('entry_id') == second.json().get('entry_id'):
+                self.idempotent_entry_id = first.json()['entry_id']
+                self.log_test("Idempotent Create Replay", True)
+                return True
+            else:
+                self.log_test("Idempotent Create Replay", False, "Replay created a new entry")
+        else:
+            self.log_test("Idempotent Create Replay", False, "Create request failed")
+        
+        return False
+
+    def test_sync_offline_operations(self):
+        """Test applying a queued batch of offline operations"""
+        if not self.worker_token:
+            self.log_test("Sync Offline Operations", False, "No worker token available")
+            return False
+        
+        data = {
+            "operations": [
+                {
+                    "idempotency_key": f"sync-create-{self.timestamp}",
+                    "op": "create",
+                    "entry": {
+                        "student_id": self.student_id,
+                        "student_name": "Test Student",
+                        "items": [{"item_type": "Bedsheet", "quantity": 2}]
+                    }
+                },
+                {
+                    # Same key as the single create above, so it must be replayed
+                    "idempotency_key": f"create-{self.timestamp}",
+                    "op": "create",
+                    "entry": {
+                        "student_id": self.student_id,
+                        "student_name": "Test Student",
+                        "items": [{"item_type": "Towel", "quantity": 1}]
+                    }
+                }
+            ]
+        }
+        
+        response = self.make_request('POST', '/laundry/sync', data, self.worker_token)
+        
+        if response and response.status_code == 200:
+            results = response.json().get('results', [])
+            if len(results) != 2 or not all(r['status_code'] == 200 for r in results):
+                self.log_test("Sync Offline Operations", False, f"Unexpected results: {results}")
+            elif results[1]['response']['entry_id'] != self.idempotent_entry_id:
+                self.log_test("Sync Offline Operations", False, "Replayed operation returned a different entry_id")
+            else:
+                self.log_test("Sync Offline Operations", True)
+                return True
+        else:
+            status = response.status_code if response else "No response"
+            self.log_test("Sync Offline Operations", False, f"Status: {status}")
+        
+        return False
+
+    def test_idempotent_complete(self):
+        """Test that retrying complete with the same Idempotency-Key replays the stored response"""
+        if not self.worker_token or not self.idempotent_entry_id:
+            self.log_test("Idempotent Complete Replay", False, "No worker token or entry ID available")
+            return False
+        
+        data = {"entry_id": self.idempotent_entry_id}
+        headers = {'Idempotency-Key': f"complete-{self.timestamp}"}
+        
+        first = self.make_request('PUT', '/laundry/complete', data, self.worker_token, headers)
+        second = self.make_request('PUT', '/laundry/complete', data, self.worker_token, headers)
+        
+        if first and second and first.status_code == 200 and second.status_code == 200:
+            if first.json() == second.json():
+                self.log_test("Idempotent Complete Replay", True)
+                return True
+            else:
+                self.log_test("Idempotent Complete Replay", False, "Replay returned a different response")
+        else:
+            self.log_test("Idempotent Complete Replay", False, "Complete request failed")
+        
+        return False
+
+    def test_idempotency_key_reuse(self):
+        """Test that reusing a key on another route or with another payload is rejected"""
+        if not self.worker_token or not self.idempotent_entry_id:
+            self.log_test("Idempotency Key Reuse Rejected", False, "No worker token or entry ID available")
+            return False
+        
+        headers = {'Idempotency-Key': f"create-{self.timestamp}"}
+        other_route = self.make_request('PUT', '/laundry/complete', {"entry_id": self.idempotent_entry_id}, self.worker_token, headers)
+        
+        data = {
+            "student_id": self.student_id,
+            "student_name": "Test Student",
+            "items": [{"item_type": "Towel", "quantity": 5}]
+        }
+        other_payload = self.make_request('POST', '/laundry/create', data, self.worker_token, headers)
+        
+        if other_route and other_payload and other_route.status_code == 422 and other_payload.status_code == 422:
+            self.log_test("Idempotency Key Reuse Rejected", True)
+            return True
+        
+        route_status = other_route.status_code if other_route else "No response"
+        payload_status = other_payload.status_code if other_payload else "No response"
+        self.log_test("Idempotency Key Reuse Rejected", False, f"Statuses: {route_status}, {payload_status} (expected 422)")
+        return False
+
+    def test_sync_batch_limit(self):
+        """Test that an oversized sync batch is rejected"""
+        if not self.worker_token:
+            self.log_test("Sync Batch Limit", False, "No worker token available")
+            return False
+        
+        # Must match SYNC_MAX_OPERATIONS on the server under test (default 100)
+        max_operations = int(os.environ.get('SYNC_MAX_OPERATIONS', 100))
+        data = {
+            "operations": [
+                {"idempotency_key": f"limit-{self.timestamp}-{i}", "op": "complete", "entry_id": "missing"}
+                for i in range(max_operations + 1)
+            ]
+        }
+        
+        response = self.make_request('POST', '/laundry/sync', data, self.worker_token)
+        
+        if response and response.status_code == 413:
+            self.log_test("Sync Batch Limit", True)
+            return True
+        
+        status = response.status_code if response else "No response"
+        self.log_test("Sync Batch Limit", False, f"Status: {status} (expected 413)")
+        return False
+
     def test_get_all_laundry_entries(self):
         """Test getting all laundry entries as worker"""
         if not self.worker_token:
@@ -302,6 +455,11 @@ class LaundrySystemTester:
         
         # Laundry management tests
         self.test_create_laundry_entry()
+        self.test_idempotent_create()
+        self.test_sync_offline_operations()
+        self.test_idempotent_complete()
+        self.test_idempotency_key_reuse()
+        self.test_sync_batch_limit()
         self.test_get_all_laundry_entries()
         self.test_get_student_laundry()
         self.test_complete_laundry()